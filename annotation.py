@@ -4,13 +4,18 @@ import logging
 import os
 import sqlite3
 
-import aiofiles
 import aiohttp
 import aiosqlite
 import aiohttp_socks
 
 from common import *
 
+MAX_BATCH = 500
+MAX_WAIT_MS = 200
+MAX_ATTEMPTS = 5
+TIMEOUT = aiohttp.ClientTimeout(total=60, sock_read=30)
+
+
 def get_observation_ids(conn : sqlite3.Connection) -> list:
     """Get all observation ids from the database."""
 
@@ -21,12 +26,12 @@ def get_observation_ids(conn : sqlite3.Connection) -> list:
     return [observation_id[0] for observation_id in observation_ids]
 
 
-async def scrape_annotations(session : aiohttp.ClientSession, conn : aiosqlite.Connection, queue : asyncio.Queue):
+async def scrape_annotations(session : aiohttp.ClientSession, write_queue : asyncio.Queue, queue : asyncio.Queue):
     """Scrape the annotations from an observation."""
 
     while True:
         
-        observation_id = await queue.get()
+        observation_id, attempts = await queue.get()
 
         try:
             async with session.get(f"https://api.inaturalist.org/v1/observations/{observation_id}", params={"locale": "en"}) as r:
@@ -42,39 +47,128 @@ async def scrape_annotations(session : aiohttp.ClientSession, conn : aiosqlite.C
                             annotations = ",".join(annotations)
 
                             print(f"Scraped {observation_id} - {annotations}")
-                            await conn.execute("UPDATE observations SET annotations=? WHERE id=?", (annotations, observation_id))
-                            await conn.commit()
+                            await write_queue.put((annotations, observation_id))
 
+                    elif data["total_results"] == 0:
+                        # deleted or hidden observations will never be found
+                        logging.info(f"Failed to scrape annotations for {observation_id}: no results.")
             
                     else:
                         logging.info(f"Failed to scrape annotations for {observation_id}: {data['total_results']} results.")
-                        await queue.put(observation_id)
+                        await retry(queue, observation_id, attempts)
+                elif r.status == 404:
+                    logging.info(f"Failed to scrape annotations for {observation_id}: not found.")
                 else:
                     logging.info(f"Failed to scrape annotations for {observation_id}: {r.status}")
-                    await queue.put(observation_id)
+                    await retry(queue, observation_id, attempts)
 
         except Exception as e:
             logging.info(f"Failed to scrape annotations for {observation_id}: {e}")
-            await queue.put(observation_id)
+            await retry(queue, observation_id, attempts)
             
         queue.task_done()
 
-async def scrape_annotations_from_ids(ids : list, limit : int = 10, proxy : str = None):
-    """Scrape the annotations from a list of observation ids."""
+async def retry(queue : asyncio.Queue, observation_id : int, attempts : int):
+    """Requeue an observation unless it has used up its attempts."""
 
-    conn = await aiosqlite.connect(DATABASE)
+    if attempts + 1 < MAX_ATTEMPTS:
+        await queue.put((observation_id, attempts + 1))
+    else:
+        logging.info(f"Giving up on {observation_id} after {MAX_ATTEMPTS} attempts.")
 
-    # set the proxy and limit
-    connector = aiohttp_socks.ProxyConnector.from_url(proxy, limit=limit)
+async def db_writer(conn : aiosqlite.Connection, write_queue : asyncio.Queue, max_batch : int = MAX_BATCH, max_wait_ms : int = MAX_WAIT_MS) -> int:
+    """Write queued annotations to the database in batches until a None sentinel is received."""
+
+    loop = asyncio.get_running_loop()
+    written = 0
+    done = False
+
+    while not done:
+        item = await write_queue.get()
+        if item is None:
+            break
+
+        batch = [item]
+        deadline = loop.time() + max_wait_ms / 1000
+
+        # drain the queue until the batch is full or the deadline passes
+        while len(batch) < max_batch:
+            # take whatever is already queued without waiting
+            if not write_queue.empty():
+                item = write_queue.get_nowait()
+            else:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+
+                try:
+                    item = await asyncio.wait_for(write_queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+
+            if item is None:
+                done = True
+                break
+
+            batch.append(item)
+
+        await conn.executemany("UPDATE observations SET annotations=? WHERE id=?", batch)
+        await conn.commit()
+
+        written += len(batch)
+        logging.info(f"Wrote {len(batch)} annotations to database.")
+
+    return written
+
+async def open_async_db(path : str = DATABASE) -> aiosqlite.Connection:
+    """Open an async database connection with the same pragmas as open_db."""
+
+    conn = await aiosqlite.connect(path)
 
-    session = aiohttp.ClientSession(connector=connector)
+    for pragma in PRAGMAS:
+        await conn.execute(pragma)
+
+    return conn
+
+async def scrape_annotations_from_ids(ids : list, limit : int = 10, proxy : str = None) -> int:
+    """Scrape the annotations from a list of observation ids, returning the number written."""
+
+    conn = await open_async_db(DATABASE)
+
+    # set the proxy and limit
+    connector = aiohttp_socks.ProxyConnector.from_url(proxy, limit=limit, limit_per_host=limit, ttl_dns_cache=300, enable_cleanup_closed=True)
 
     queue = asyncio.Queue()
+    write_queue = asyncio.Queue(maxsize=MAX_BATCH * 2)
 
     for observation_id in ids:
-        await queue.put(observation_id)
+        await queue.put((observation_id, 0))
+
+    try:
+        async with aiohttp.ClientSession(connector=connector, timeout=TIMEOUT) as session:
+            async with asyncio.TaskGroup() as tg:
+                # the writer runs in the task group so a database error cancels the workers
+                writer = tg.create_task(db_writer(conn, write_queue))
+
+                # start one worker per connection
+                workers = [tg.create_task(scrape_annotations(session, write_queue, queue)) for _ in range(limit)]
+
+                # wait until every observation has been scraped
+                await queue.join()
 
-    await scrape_annotations(session, conn, queue)
+                for worker in workers:
+                    worker.cancel()
+
+                # flush the remaining annotations
+                await write_queue.put(None)
+
+        written = writer.result()
+
+    finally:
+        await conn.execute("PRAGMA optimize")
+        await conn.close()
+
+    return written
 
 def main():
     parser = argparse.ArgumentParser()
@@ -96,22 +190,18 @@ def main():
         os.makedirs(LOG_DIR)
 
     # create the database connection
-    conn = sqlite3.connect(DATABASE)
+    conn = open_db(DATABASE)
 
     # get a list of all observation ids
     ids = get_observation_ids(conn)
 
-    # scrape the annotations for all observation ids
-    annotations = asyncio.run(scrape_annotations_from_ids(ids, args.limit, args.proxy))
-
-    # write the annotations to the database
-    conn.executemany("UPDATE observations SET annotations=? WHERE id=?", annotations)
-    conn.commit()
+    # close the database connection
+    close_db(conn)
 
-    logging.info(f"Wrote {len(annotations)} annotations to database.")
+    # scrape the annotations for all observation ids, writing them to the database in batches
+    written = asyncio.run(scrape_annotations_from_ids(ids, args.limit, args.proxy))
 
-    # close the database connection
-    conn.close()
+    logging.info(f"Wrote {written} annotations to database.")
 
 if __name__ == "__main__":
 
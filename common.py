@@ -1,4 +1,33 @@
+import sqlite3
+
 IMAGE_DIR = "images"
 EXPORT_DIR = "exports"
 LOG_DIR = "logs"
 DATABASE = "observation.db"
+
+# pragmas applied to every database connection
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-65536",
+)
+
+
+def open_db(path : str = DATABASE) -> sqlite3.Connection:
+    """Open a database connection in WAL mode with tuned pragmas."""
+
+    conn = sqlite3.connect(path)
+
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+
+    return conn
+
+
+def close_db(conn : sqlite3.Connection):
+    """Update the query planner statistics and close the connection."""
+
+    conn.execute("PRAGMA optimize")
+    conn.close()
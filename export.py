@@ -4,19 +4,27 @@ import argparse
 import json
 import time
 import logging
+import math
+from concurrent.futures import ThreadPoolExecutor
 
 import tqdm
+from lxml import html
 
 from common import *
 
 
 MAX_EXPORT = 200000
-CHUNK_SIZE = 65536
+CHUNK_SIZE = 262144
+POLL_DELAY = 0.5
+MAX_POLL_DELAY = 30
+MAX_RETRY_AFTER = 120
+MAX_THROTTLED_POLLS = 20
 
 class INaturalistExporter:
-    def __init__(self, username, password):
+    def __init__(self, username, password, sleep : float = 0.0):
         self.session = requests.Session()
         self.export_id = None
+        self.sleep = sleep
         self.logger = logging.getLogger("INaturalistExporter")
         
         # if username or password is None, prompt for credentials
@@ -51,88 +59,186 @@ class INaturalistExporter:
             self.logger.info("Login successful")
     
     
-    def export(self, taxon_ids : list | int, export_dir : str = EXPORT_DIR):
+    def export(self, taxon_ids : list | int, export_dir : str = EXPORT_DIR, force : bool = False, threads : int = 1):
         # convert to list if necessary
         if isinstance(taxon_ids, int):
             taxon_ids = [taxon_ids]
         
         # count results for the query
-        query, query_encoded = self._get_query(taxon_ids)
+        query, _ = self._get_query(taxon_ids)
         total_results = self._count_results(query)
     
-        if total_results == False:
+        if total_results is False:
             raise ValueError("Failed to count results")
         if total_results == 0:
             raise ValueError("No results found")        
-        if total_results > MAX_EXPORT:
-            raise ValueError(f"Too many results ({total_results} > {MAX_EXPORT})")
         
         self.logger.debug(f"Found {total_results} results")
 
-        # navigate to export page for the first time
-        r = self.session.get("https://www.inaturalist.org/observations/export")
-        r.raise_for_status()
+        # split the taxon ids into several exports if they would exceed the limit
+        if total_results > MAX_EXPORT:
+            groups = self._split_taxon_ids(taxon_ids)
+            self.logger.info(f"Splitting {total_results} results into {len(groups)} exports")
+        else:
+            groups = [(taxon_ids, total_results)]
+
+        # run the exports concurrently, each one mostly waits on the server
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = [
+                executor.submit(self._export_single, group, group_results, export_dir, force, position)
+                for position, (group, group_results) in enumerate(groups)
+            ]
+
+            for future in futures:
+                future.result()
+
+
+    def _export_single(self, taxon_ids : list, total_results : int, export_dir : str, force : bool, position : int = 0):
+        # each export gets its own session so concurrent CSRF handshakes don't share a cookie jar
+        with self._clone_session() as session:
+            _, query_encoded = self._get_query(taxon_ids)
+
+            time.sleep(self.sleep)
+
+            # navigate to export page for the first time
+            r = session.get("https://www.inaturalist.org/observations/export")
+            r.raise_for_status()
     
-        # build form
-        form = self._build_form(query_encoded)
-        
-        # create headers
-        headers = {
-            "Accept": "application/json, text/javascript, */*; q=0.01",
-            "Referer": "https://www.inaturalist.org/observations/export",
-            "X-CSRF-Token": self._parse_csrf(r),
-            "X-Requested-With": "XMLHttpRequest"
-        }
+            # build form
+            form = self._build_form(query_encoded)
+        
+            # create headers
+            headers = {
+                "Accept": "application/json, text/javascript, */*; q=0.01",
+                "Referer": "https://www.inaturalist.org/observations/export",
+                "X-CSRF-Token": self._parse_csrf(r),
+                "X-Requested-With": "XMLHttpRequest"
+            }
 
-        # post form
-        r = self.session.post("https://www.inaturalist.org/flow_tasks", data=form, headers=headers)
+            # post form
+            r = session.post("https://www.inaturalist.org/flow_tasks", data=form, headers=headers)
 
-        if r.status_code == 422:
-            self.logger.error("Export failed with status code 422 (Unprocessable Entity)")
-            raise ValueError(r.json()["error"])
+            if r.status_code == 422:
+                self.logger.error("Export failed with status code 422 (Unprocessable Entity)")
+                raise ValueError(r.json()["error"])
         
-        self.logger.info(f"Export request sent for ids {taxon_ids} with {total_results} results. Waiting for export to complete...")
+            self.logger.info(f"Export request sent for ids {taxon_ids} with {total_results} results. Waiting for export to complete...")
         
-        # get export ID  
-        export_id = r.json()["id"]
+            # get export ID  
+            export_id = r.json()["id"]
 
-        # wait for export to complete
-        completed = False
-        while not completed:
-            r = self.session.get(f"https://www.inaturalist.org/flow_tasks/{export_id}/run.json")
-            r.raise_for_status()
+            # wait for export to complete, backing off between polls
+            completed = False
+            delay = POLL_DELAY
+            throttled = 0
+            while not completed:
+                r = session.get(f"https://www.inaturalist.org/flow_tasks/{export_id}/run.json")
+
+                # wait as long as the server asks when it is rate limiting or busy, up to a limit
+                if r.status_code in (429, 503) and throttled < MAX_THROTTLED_POLLS:
+                    throttled += 1
+                    time.sleep(self._retry_after(r, delay))
+                    delay = min(delay * 1.5, MAX_POLL_DELAY)
+                    continue
 
-            data = r.json()
+                r.raise_for_status()
+
+                data = r.json()
             
-            if len(data["outputs"]) > 0:
-                completed = True
-            else:
-                time.sleep(2)
+                if len(data["outputs"]) > 0:
+                    completed = True
+                else:
+                    time.sleep(delay)
+                    delay = min(delay * 1.5, MAX_POLL_DELAY)
     
-        self.logger.info("Export complete")    
+            self.logger.info("Export complete")    
+
+            # download export
+            output = data["outputs"][0]
+            filename = output["file_file_name"]
+            url = f"https://www.inaturalist.org/attachments/flow_task_outputs/{output['id']}/{filename}"
 
-        # download export
-        output = data["outputs"][0]
-        filename = output["file_file_name"]
-        url = f"https://www.inaturalist.org/attachments/flow_task_outputs/{output['id']}/{filename}"
+            download_path = os.path.join(export_dir, filename)
 
-        r = self.session.get(url, stream=True)
-        total_size = int(r.headers.get("content-length", 0))
+            if os.path.exists(download_path) and not force:
+                self.logger.info(f"Export already exists at {download_path}, skipping download")
+                return
+
+            r = session.get(url, stream=True)
+            r.raise_for_status()
+            total_size = int(r.headers.get("content-length", 0))
         
-        download_path = os.path.join(export_dir, filename)
+            # write to a temporary file so an interrupted download is never mistaken for a complete one
+            part_path = download_path + ".part"
         
-        with open(filename, "wb") as f:
-            with tqdm.tqdm(total=total_size, unit="iB", unit_scale=True) as pbar:
-                for chunk in r.iter_content(chunk_size=65535):
-                    if chunk:
-                        f.write(chunk)
-                        pbar.update(len(chunk))
+            with open(part_path, "wb") as f:
+                with tqdm.tqdm(total=total_size, unit="iB", unit_scale=True, desc=filename, position=position) as pbar:
+                    for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                        if chunk:
+                            f.write(chunk)
+                            pbar.update(len(chunk))
+
+            os.replace(part_path, download_path)
 
-        self.logger.info(f"Export saved to {filename}")
+            self.logger.info(f"Export saved to {download_path}")
         
     
+    def _clone_session(self) -> requests.Session:
+        # copy the logged in cookies and headers into a new session
+        session = requests.Session()
+        session.headers.update(self.session.headers)
+        session.cookies.update(self.session.cookies)
+
+        return session
+
     def _parse_csrf(self, response):
-        return response.text.split('name="csrf-token" content="')[1].split('"')[0]
+        tree = html.fromstring(response.content)
+        return tree.xpath('//meta[@name="csrf-token"]/@content')[0]
+
+    def _split_taxon_ids(self, taxon_ids : list) -> list:
+        # greedily pack taxon ids into groups of at most MAX_EXPORT results
+        groups = []
+        group, group_results = [], 0
+
+        for taxon_id in taxon_ids:
+            time.sleep(self.sleep)
+
+            query, _ = self._get_query([taxon_id])
+            results = self._count_results(query)
+
+            if results is False:
+                raise ValueError(f"Failed to count results for taxon {taxon_id}")
+            if results > MAX_EXPORT:
+                raise ValueError(f"Too many results for taxon {taxon_id} ({results} > {MAX_EXPORT})")
+            if results == 0:
+                self.logger.info(f"No results found for taxon {taxon_id}, skipping")
+                continue
+
+            if group and group_results + results > MAX_EXPORT:
+                groups.append((group, group_results))
+                group, group_results = [], 0
+
+            group.append(taxon_id)
+            group_results += results
+
+        if group:
+            groups.append((group, group_results))
+
+        return groups
+
+    def _retry_after(self, response, default : float) -> float:
+        # honor the server's Retry-After header if it gives a number of seconds
+        retry_after = response.headers.get("Retry-After")
+
+        try:
+            seconds = float(retry_after)
+        except (TypeError, ValueError):
+            return default
+
+        if not math.isfinite(seconds):
+            return default
+
+        return max(0.0, min(seconds, MAX_RETRY_AFTER))
 
     def _get_query(self, taxon_ids : list):
         query_dict = {
@@ -177,6 +283,7 @@ def get_args():
     parser.add_argument("-t", "--threads", type=int, default=10, help="Number of threads to use")
     parser.add_argument("-s", "--sleep", type=float, default=0.0, help="Number of seconds to sleep between requests")
     parser.add_argument("-v", "--verbose", action="store_true", help="Print progress to stdout")
+    parser.add_argument("-f", "--force", action="store_true", help="Overwrite existing exports")
 
     return parser.parse_args()
 
@@ -213,6 +320,6 @@ if __name__ == "__main__":
     create_export_dir()
     
     # create exporter
-    exporter = INaturalistExporter(args.username, args.password)
+    exporter = INaturalistExporter(args.username, args.password, sleep=args.sleep)
     
-    exporter.export(args.taxon_id)
\ No newline at end of file
+    exporter.export(args.taxon_id, force=args.force, threads=args.threads)
\ No newline at end of file
@@ -15,96 +15,205 @@ import tqdm
 
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 
 from common import *
 
 IMAGE_SIZES = ("small", "medium", "large", "original")
+CHUNK_SIZE = 262144
+WRITE_SIZE = 1048576
+# columns kept verbatim rather than letting pyarrow infer dates and times from them
+TEXT_COLUMNS = (
+    "observed_on_string", "observed_on", "time_observed_at", "time_zone", "created_at", "updated_at",
+    "description", "tag_list", "place_guess", "private_place_guess",
+)
+# no total timeout, large images can take a while but the socket should never stall
+TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=30)
+
+
+def read_observations(path : str) -> pd.DataFrame:
+    # read the csv file inside the export zip
+    with zipfile.ZipFile(path) as zf:
+        with zf.open(os.path.basename(path).rstrip(".zip")) as f:
+            table = pacsv.read_csv(
+                f,
+                read_options=pacsv.ReadOptions(use_threads=True, block_size=16 << 20),
+                convert_options=pacsv.ConvertOptions(
+                    column_types={column: pa.string() for column in TEXT_COLUMNS},
+                    strings_can_be_null=True,
+                ),
+            )
+
+    df = table.to_pandas(integer_object_nulls=True)
+
+    # blank cells become None so sqlite3 stores them as NULL
+    return df.astype(object).where(df.notna(), None)
+
+
+def insert_observations(conn : sqlite3.Connection, df : pd.DataFrame) -> int:
+    columns = ", ".join(f'"{column}"' for column in df.columns)
+    placeholders = ", ".join("?" for _ in df.columns)
+
+    # observations already in the database are skipped by the primary key
+    cursor = conn.executemany(f"INSERT OR IGNORE INTO observations ({columns}) VALUES ({placeholders})", df.itertuples(index=False, name=None))
+
+    return cursor.rowcount
+
+
+def observations_schema(columns : list) -> str:
+    return ", ".join('"id" INTEGER PRIMARY KEY' if column == "id" else f'"{column}"' for column in columns)
+
+
+def prepare_observations_table(conn : sqlite3.Connection, columns : list):
+    # map each existing column to whether it is the primary key
+    existing = {name: pk for _, name, _, _, _, pk in conn.execute("PRAGMA table_info(observations)")}
+
+    if not existing:
+        conn.execute(f"CREATE TABLE observations ({observations_schema(columns)})")
+        return
+
+    # tables from older versions have no key on id, rebuild them so known observations are skipped
+    if "id" in existing and not existing["id"]:
+        logging.info("Rebuilding observations table with id as primary key.")
+
+        names = ", ".join(f'"{name}"' for name in existing)
+        order = " ORDER BY annotations IS NULL" if "annotations" in existing else ""
+
+        conn.execute("ALTER TABLE observations RENAME TO observations_old")
+        conn.execute(f"CREATE TABLE observations ({observations_schema(list(existing))})")
+        conn.execute(f"INSERT OR IGNORE INTO observations ({names}) SELECT {names} FROM observations_old{order}")
+        conn.execute("DROP TABLE observations_old")
+
+    # add any columns this export has that the table is missing
+    for column in columns:
+        if column not in existing:
+            conn.execute(f'ALTER TABLE observations ADD COLUMN "{column}"')
 
 
 def load_observations(export_dir : str = EXPORT_DIR):
-    dataframes = []
-
-    for file in os.listdir(export_dir):
-        if file.endswith(".zip"):
-            # read the csv file
-            with zipfile.ZipFile(os.path.join(export_dir, file)) as zf:
-                with zf.open(file.rstrip(".zip")) as f:
-                    df = pd.read_csv(f)
-                
-            # add the dataframe to the list
-            dataframes.append(df)
-        
-    # concatenate all dataframes
-    df = pd.concat(dataframes) 
+    total = 0
+    created = False
 
-    # drop duplicates
-    df.drop_duplicates(inplace=True)
-    
-    # add empty column annotations
-    df["annotations"] = None
+    # write to database in a single transaction, one export at a time
+    conn = open_db(DATABASE)
+
+    with conn:
+        conn.execute("BEGIN")
+
+        for file in os.listdir(export_dir):
+            if file.endswith(".zip"):
+                df = read_observations(os.path.join(export_dir, file))
 
-    # write to database
-    conn = sqlite3.connect(DATABASE)
-    df.to_sql("observations", conn, index=False, if_exists="replace")
+                # add empty column annotations
+                df["annotations"] = None
 
-    conn.commit()
-    conn.close()
+                # create or update the table, keeping any existing rows and annotations
+                prepare_observations_table(conn, list(df.columns))
+                created = True
+
+                total += insert_observations(conn, df)
+
+        # index the scan for unannotated observations, lookups by id use the primary key
+        if created:
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_obs_null_annot ON observations(id) WHERE annotations IS NULL")
+
+    close_db(conn)
     
-    logging.info(f"Wrote {len(df)} observations to database.")
+    logging.info(f"Wrote {total} new observations to database.")
 
 
 
 def get_urls(conn, image_size : str, force : bool = False) -> list:
-    urls = []
+    df = pd.read_sql_query("SELECT id, taxon_id, image_url FROM observations", conn)
+    df = df.dropna(subset=["image_url"]).reset_index(drop=True)
 
-    # iterate over all observations
-    for image_id, taxon_id, image_url in conn.execute("SELECT id, taxon_id, image_url FROM observations"):
-        name, ext = os.path.splitext(os.path.basename(image_url))
-        
-        # check for file extensions
-        if ext == ".gif":
-            continue
-        if ext == ".":
-            ext = ".jpg"
-            
-        
-        if not os.path.exists(os.path.join(IMAGE_DIR, f"{image_id}{ext}")) or force:
-            image_url = image_url.replace("medium", image_size)
+    # get the file extension of each image
+    basename = df["image_url"].str.rsplit("/", n=1).str[-1]
+    df["ext"] = basename.str.extract(r"(\.[^.]*)$", expand=False).fillna("")
+    df.loc[df["ext"] == ".", "ext"] = ".jpg"
 
-            urls.append((image_id, taxon_id, image_url))
-        
-    return urls
+    # request the desired image size
+    df["image_url"] = df["image_url"].str.replace("medium", image_size, regex=False)
+
+    # skip gifs
+    mask = df["ext"] != ".gif"
+
+    # skip images which have already been downloaded
+    if not force:
+        existing = set(os.listdir(IMAGE_DIR))
+        mask &= ~(df["id"].astype(str) + df["ext"]).isin(existing)
+
+    # taxon ids are read back as floats when any are NULL, restore ints and None
+    urls = df.loc[mask, ["id", "taxon_id", "image_url"]].astype({"taxon_id": "Int64"}).astype(object)
+    urls = urls.where(urls.notna(), None)
+
+    return list(urls.itertuples(index=False, name=None))
 
 
 async def download_image(session : aiohttp.ClientSession, image_id : int, taxon_id : int, image_url : str):
+    ext = os.path.splitext(os.path.basename(image_url))[1]
+    path = os.path.join(IMAGE_DIR, f"{image_id}{ext}")
+
+    # write to a temporary file so an interrupted download is never mistaken for a complete one
+    part_path = path + ".part"
+
     try:
         async with session.get(image_url) as resp:
             if resp.status == 200:
-                ext = os.path.splitext(os.path.basename(image_url))[1]
-                
-                async with aiofiles.open(os.path.join(IMAGE_DIR, f"{image_id}{ext}"), "wb") as f:
-                    await f.write(await resp.read())
+                async with aiofiles.open(part_path, "wb") as f:
+                    # buffer chunks so each write call covers up to WRITE_SIZE bytes
+                    buffer = bytearray()
+                    
+                    async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                        buffer += chunk
+                        
+                        if len(buffer) >= WRITE_SIZE:
+                            await f.write(buffer)
+                            buffer.clear()
                     
-                    logging.info(f"Saved {image_id} for taxon {taxon_id}.")
+                    if buffer:
+                        await f.write(buffer)
+
+                os.replace(part_path, path)
+                    
+                logging.info(f"Saved {image_id} for taxon {taxon_id}.")
                 
             else:
                 logging.info(f"Failed to download {image_id} for taxon {taxon_id}: {resp.status}")
     except Exception as e:
         logging.info(f"Failed to download {image_id} for taxon {taxon_id}: {e}")
 
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+async def download_worker(session : aiohttp.ClientSession, queue : asyncio.Queue):
+    while True:
+        image_id, taxon_id, image_url = await queue.get()
+
+        try:
+            await download_image(session, image_id, taxon_id, image_url)
+        finally:
+            queue.task_done()
+
 async def download_images(urls : list, image_size : str, semaphore : int = 10):
-    async with aiohttp.ClientSession() as session:
-        tasks = []
+    connector = aiohttp.TCPConnector(limit=semaphore, limit_per_host=semaphore, ttl_dns_cache=300)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=TIMEOUT) as session:
+        queue = asyncio.Queue()
         
-        # create a semaphore to limit the number of concurrent downloads
-        sem = asyncio.Semaphore(semaphore)
+        for url in urls:
+            queue.put_nowait(url)
         
-        for image_id, taxon_id, image_url in urls:
-            # wait until the semaphore is available
-            async with sem:
-                tasks.append(asyncio.create_task(download_image(session, image_id, taxon_id, image_url)))
+        # start a fixed pool of workers to limit the number of concurrent downloads
+        workers = [asyncio.create_task(download_worker(session, queue)) for _ in range(semaphore)]
                 
-        await asyncio.gather(*tasks)
+        await queue.join()
+        
+        for worker in workers:
+            worker.cancel()
+        
+        await asyncio.gather(*workers, return_exceptions=True)
     
     logging.info(f"Downloaded {image_size} images.")
 
@@ -136,13 +245,13 @@ if __name__ == "__main__":
     load_observations()
 
     # connect to the database
-    conn = sqlite3.connect(DATABASE)
+    conn = open_db(DATABASE)
 
     # get the urls
     urls = get_urls(conn, args.size, args.force)
     
     # close the connection
-    conn.close()
+    close_db(conn)
     
     # download the images
     asyncio.run(download_images(urls, args.size, args.semaphore))
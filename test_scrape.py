@@ -0,0 +1,108 @@
+import os
+import sqlite3
+import zipfile
+
+import scrape
+
+
+def write_export(export_dir, name, csv):
+    with zipfile.ZipFile(os.path.join(export_dir, f"{name}.csv.zip"), "w") as zf:
+        zf.writestr(f"{name}.csv", csv)
+
+
+def test_load_observations_blank_cells(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("exports")
+
+    write_export("exports", "observations-1", (
+        "id,observed_on,latitude,taxon_id,image_url,description\n"
+        "1,2023-05-01,,5,https://example.org/photos/1/medium.jpg,\n"
+        "2,2023-05-02,1.5,,https://example.org/photos/2/medium.jpg,hello\n"
+    ))
+
+    scrape.load_observations("exports")
+
+    conn = sqlite3.connect(scrape.DATABASE)
+    rows = conn.execute("SELECT id, observed_on, latitude, taxon_id, description, annotations FROM observations ORDER BY id").fetchall()
+    conn.close()
+
+    assert rows == [
+        (1, "2023-05-01", None, 5, None, None),
+        (2, "2023-05-02", 1.5, None, "hello", None),
+    ]
+
+
+def test_load_observations_keeps_timestamps_verbatim(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("exports")
+
+    write_export("exports", "observations-1", (
+        "id,observed_on_string,time_observed_at,created_at,image_url\n"
+        "1,2023-05-01T12:34:56-07:00,2023-05-01 19:34:56 UTC,2023-05-02 08:00,https://example.org/photos/1/medium.jpg\n"
+        "2,2023-05-01T12:34:56.25-07:00,,2023-05-02 08:00:01,https://example.org/photos/2/medium.jpg\n"
+    ))
+
+    scrape.load_observations("exports")
+
+    conn = sqlite3.connect(scrape.DATABASE)
+    rows = conn.execute("SELECT id, observed_on_string, time_observed_at, created_at FROM observations ORDER BY id").fetchall()
+    conn.close()
+
+    assert rows == [
+        (1, "2023-05-01T12:34:56-07:00", "2023-05-01 19:34:56 UTC", "2023-05-02 08:00"),
+        (2, "2023-05-01T12:34:56.25-07:00", None, "2023-05-02 08:00:01"),
+    ]
+
+
+def test_load_observations_migrates_unkeyed_table(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("exports")
+
+    # a table as written by the old df.to_sql loader, with no key on id
+    conn = sqlite3.connect(scrape.DATABASE)
+    conn.execute('CREATE TABLE observations ("id", "image_url", "annotations")')
+    conn.executemany("INSERT INTO observations VALUES (?, ?, ?)", [
+        (1, "https://example.org/photos/1/medium.jpg", None),
+        (1, "https://example.org/photos/1/medium.jpg", "Adult"),
+    ])
+    conn.commit()
+    conn.close()
+
+    write_export("exports", "observations-1", (
+        "id,image_url,taxon_id\n"
+        "1,https://example.org/photos/1/medium.jpg,5\n"
+        "2,https://example.org/photos/2/medium.jpg,6\n"
+    ))
+
+    scrape.load_observations("exports")
+    scrape.load_observations("exports")
+
+    conn = sqlite3.connect(scrape.DATABASE)
+    rows = conn.execute("SELECT id, taxon_id, annotations FROM observations ORDER BY id").fetchall()
+    conn.close()
+
+    assert rows == [(1, None, "Adult"), (2, 6, None)]
+
+
+def test_get_urls_keeps_taxon_ids(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(scrape.IMAGE_DIR)
+    open(os.path.join(scrape.IMAGE_DIR, "3.jpg"), "wb").close()
+
+    conn = sqlite3.connect(":memory:")
+    conn.execute('CREATE TABLE observations ("id" INTEGER PRIMARY KEY, "taxon_id", "image_url")')
+    conn.executemany("INSERT INTO observations VALUES (?, ?, ?)", [
+        (1, 5, "https://example.org/photos/1/medium.jpg"),
+        (2, None, "https://example.org/photos/2/medium.jpeg"),
+        (3, 6, "https://example.org/photos/3/medium.jpg"),
+        (4, 7, "https://example.org/photos/4/medium.gif"),
+    ])
+
+    urls = scrape.get_urls(conn, "large")
+    conn.close()
+
+    assert urls == [
+        (1, 5, "https://example.org/photos/1/large.jpg"),
+        (2, None, "https://example.org/photos/2/large.jpeg"),
+    ]
+    assert [type(taxon_id) for _, taxon_id, _ in urls] == [int, type(None)]